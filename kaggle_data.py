@@ -6,6 +6,15 @@ to centralise functions to load and manipulate data so
 to not replicate code.
 """
 
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from multiprocessing import Pool
+from queue import Queue
+
 import pandas as pd
 import numpy as np
 from sklearn.preprocessing import StandardScaler
@@ -13,7 +22,8 @@ from sklearn.preprocessing import LabelEncoder
 from keras.utils import np_utils
 
 
-def load_data(path, train=True):
+def load_data(path, train=True, cache=False, chunksize=100000, seed=None,
+              return_permutation=False):
     """Load data from a CSV File
     
     Parameters
@@ -25,40 +35,525 @@ def load_data(path, train=True):
         Decide whether or not data are *training data*.
         If True, some random shuffling is applied.
         
+    seed: int (default None)
+        Seed of the shuffling permutation, for reproducible runs.
+        
+    return_permutation: bool (default False)
+        If True, training data are returned in file order together
+        with the shuffling permutation instead of being reordered,
+        so that shuffling costs no copy of the features
+        (see `iter_batches`).
+        
+    cache: bool (default False)
+        If True, the parsed arrays are saved next to the CSV file
+        on the first load (see `load_cached_data`), and memory-mapped
+        from there on later loads as long as the CSV file is unchanged.
+        
+    chunksize: int (default 100000)
+        Number of rows parsed at a time.
+        
     Return
     ------
     X: numpy.ndarray 
         The data as a multi dimensional array of floats
     ids: numpy.ndarray
         A vector of ids for each sample
+    perm: numpy.ndarray
+        The shuffling permutation, only if `return_permutation`
     """
-    df = pd.read_csv(path)
-    X = df.values.copy()
+    if cache:
+        X, y = load_cached_data(path, train=train, chunksize=chunksize)
+    else:
+        X, y = _parse_csv(path, train=train, chunksize=chunksize)
+    return _shuffle(X, y, train, seed, return_permutation)
+
+
+def _shuffle(X, y, train, seed, return_permutation):
     if train:
-        np.random.shuffle(X)  # https://youtu.be/uyUXoap67N8
-        X, labels = X[:, 1:-1].astype(np.float32), X[:, -1]
-        return X, labels
+        rng = np.random.RandomState(seed)
+        perm = rng.permutation(X.shape[0])  # https://youtu.be/uyUXoap67N8
+        if return_permutation:
+            return X, y, perm
+        X, y = X[perm], y[perm]
+    return X, y
+
+
+def load_data_many(paths, train=True, workers=None, chunksize=100000,
+                   seed=None, return_permutation=False):
+    """Load data from several CSV files with the same columns
+
+    The files are counted and then parsed concurrently by a pool of
+    `workers` processes, which write their features straight into one
+    preallocated matrix shared through a memory-mapped temporary file
+    (in `/dev/shm` where available, i.e. in RAM), so only the labels
+    (or ids) are sent back to this process. The returned features are a
+    `numpy.memmap` of that file, whose name is removed once parsed.
+    Rows are concatenated in the order of `paths`; shuffling works as
+    in `load_data`.
+
+    Parameters
+    ----------
+    paths: list of str
+        The paths to the CSV files
+
+    workers: int (default None)
+        Number of worker processes, by default the number of CPUs
+
+    Other parameters and return values are as in `load_data`.
+    """
+    columns = list(pd.read_csv(paths[0], nrows=0).columns)
+    n_features = len(columns) - (2 if train else 1)
+    pool = Pool(workers)
+    try:
+        counts = pool.map(_count_rows, paths)
+        offsets = np.cumsum([0] + counts)
+        shape = (max(1, int(offsets[-1])), n_features)
+        shared_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        fd, X_path = tempfile.mkstemp(suffix='.npy', dir=shared_dir)
+        os.close(fd)
+        try:
+            X = np.memmap(X_path, dtype=np.float32, mode='w+', shape=shape)
+            tasks = [(path, train, chunksize, X_path, shape, int(start),
+                      count)
+                     for path, start, count in zip(paths, offsets, counts)]
+            ys = pool.map(_parse_csv_shared, tasks)
+        finally:
+            try:
+                # The mapping outlives the name, except on Windows, where
+                # the file stays in the temporary directory.
+                os.remove(X_path)
+            except OSError:
+                pass
+    finally:
+        pool.close()
+        pool.join()
+    # Each file got the rows `_count_rows` bounds it to: close the gaps.
+    stop = 0
+    for start, y_part in zip(offsets, ys):
+        start, count = int(start), len(y_part)
+        if start != stop:
+            for i in range(0, count, chunksize):
+                n = min(chunksize, count - i)
+                X[stop + i:stop + i + n] = X[start + i:start + i + n]
+        stop += count
+    X = X[:stop]
+    y = np.concatenate(ys) if ys else np.empty(0, dtype=object)
+    return _shuffle(X, y, train, seed, return_permutation)
+
+
+def _parse_csv_shared(task):
+    """Worker of `load_data_many`: parse one CSV file into at most `count`
+    rows of the shared feature matrix, from row `start` on, and return
+    its labels (or ids)."""
+    path, train, chunksize, X_path, shape, start, count = task
+    X = np.memmap(X_path, dtype=np.float32, mode='r+', shape=shape)
+    y = np.empty(count, dtype=object)
+    stop = start
+    for X_chunk, y_chunk in _iter_csv_chunks(path, train, chunksize):
+        y[stop - start:stop - start + len(y_chunk)] = y_chunk
+        X[stop:stop + len(X_chunk)] = X_chunk
+        stop += len(X_chunk)
+    del X
+    y = y[:stop - start]
+    if train:
+        return y
+    return y.astype(str)
+
+
+def iter_batches(X, y, batch_size, perm=None, seed=None):
+    """Generate `(X, y)` batches in shuffled order, endlessly.
+
+    Rows are gathered batch by batch, so the arrays are never reordered.
+    The first epoch follows `perm` if given (e.g. as returned by
+    `load_data(..., return_permutation=True)`); every epoch after that
+    draws a new permutation from `seed`. With the same `seed` as
+    `load_data`, the permutation it drew is skipped, so the second epoch
+    does not repeat the first.
+    """
+    rng = np.random.RandomState(seed)
+    n_samples = X.shape[0]
+    first = rng.permutation(n_samples)
+    if perm is None:
+        perm = first
+    while True:
+        for start in range(0, n_samples, batch_size):
+            rows = perm[start:start + batch_size]
+            yield X[rows], y[rows]
+        perm = rng.permutation(n_samples)
+
+
+def _count_rows(path):
+    """Return an upper bound on the number of data rows of a CSV file.
+
+    Every line break (`\n`, `\r\n` or a lone `\r`, as accepted by
+    pandas) but the header's is counted, so blank lines and line breaks
+    inside quoted fields only make the bound loose: callers allocate
+    this many rows and keep the ones actually parsed."""
+    lines, last = 0, b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            lines += block.count(b'\n') + block.count(b'\r')
+            lines -= block.count(b'\r\n')
+            if last == b'\r' and block[:1] == b'\n':
+                lines -= 1  # A `\r\n` split across two blocks.
+            last = block[-1:]
+    if last not in (b'\n', b'\r'):
+        lines += 1
+    return max(lines - 1, 0)
+
+
+def _iter_csv_chunks(path, train=True, chunksize=100000):
+    """Generate `(X, y)` chunks of a CSV file: float32 features and
+    labels (training data) or ids, with column types declared up front."""
+    columns = list(pd.read_csv(path, nrows=0).columns)
+    if train:
+        features, key = columns[1:-1], columns[-1]
     else:
-        X, ids = X[:, 1:].astype(np.float32), X[:, 0].astype(str)
-        return X, ids
-        
-        
-def preprocess_data(X, scaler=None):
+        features, key = columns[1:], columns[0]
+    dtype = dict((name, np.float32) for name in features)
+    dtype[key] = str
+    reader = pd.read_csv(path, usecols=features + [key], dtype=dtype,
+                         chunksize=chunksize)
+    try:
+        for chunk in reader:
+            yield chunk[features].values, chunk[key].values
+    finally:
+        reader.close()
+
+
+def _parse_csv(path, train=True, chunksize=100000):
+    """Parse the CSV file into float32 features and labels (or ids),
+    in file order.
+
+    Column types are declared up front and the file is read `chunksize`
+    rows at a time straight into a preallocated float32 matrix, so the
+    whole table never exists as an `object` array."""
+    n_rows = _count_rows(path)
+    X, y = None, np.empty(n_rows, dtype=object)
+    start = 0
+    for X_chunk, y_chunk in _iter_csv_chunks(path, train, chunksize):
+        if X is None:
+            X = np.empty((n_rows, X_chunk.shape[1]), dtype=np.float32)
+        stop = start + len(X_chunk)
+        X[start:stop] = X_chunk
+        y[start:stop] = y_chunk
+        start = stop
+    if X is None:
+        X = np.empty((0, 0), dtype=np.float32)
+    # Blank lines and quoted line breaks were counted as rows: drop them.
+    X, y = X[:start], y[:start]
+    if train:
+        return X, y
+    return X, y.astype(str)
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cache_paths(path, train=True):
+    prefix = '%s.%s' % (path, 'train' if train else 'test')
+    return prefix + '.json', prefix + '.X.npy', prefix + '.y.npy'
+
+
+def load_cached_data(path, train=True, chunksize=100000):
+    """Load the data of a CSV file through a binary cache.
+
+    The features are stored as a contiguous float32 `.npy` file and
+    the labels (or ids) as a string `.npy` file next to the CSV file,
+    together with a `.json` file recording the size, modification time
+    and SHA-256 of the CSV file they were parsed from. The cache is used
+    as long as the size matches and either the modification time or,
+    failing that, the hash does; otherwise the CSV file is parsed again.
+
+    Parameters
+    ----------
+    path: str
+        The path to the CSV file
+
+    train: bool (default True)
+        Decide whether or not data are *training data*.
+
+    chunksize: int (default 100000)
+        Number of rows parsed at a time when the cache is (re)built.
+
+    Return
+    ------
+    X: numpy.memmap
+        The data in file order, memory-mapped read-only
+    y: numpy.ndarray
+        The labels (training data) or the ids of each sample
+    """
+    meta_path, X_path, y_path = _cache_paths(path, train=train)
+    stat = os.stat(path)
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['size'] == stat.st_size:
+            if (meta['mtime'] != stat.st_mtime
+                    and meta['sha256'] == _sha256(path)):
+                # Touched but unchanged: remember the new time.
+                meta['mtime'] = stat.st_mtime
+                with open(meta_path, 'w') as f:
+                    json.dump(meta, f)
+            if meta['mtime'] == stat.st_mtime:
+                try:
+                    return np.load(X_path, mmap_mode='r'), np.load(y_path)
+                except IOError:
+                    pass  # An array is missing: rebuild the cache.
+        os.remove(meta_path)
+
+    X, y = _parse_csv(path, train=train, chunksize=chunksize)
+    _save_replace(X_path, np.ascontiguousarray(X))
+    _save_replace(y_path, y.astype(str))
+    # Written last, so that an interrupted update leaves no valid cache.
+    meta = {'size': stat.st_size, 'mtime': stat.st_mtime,
+            'sha256': _sha256(path)}
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return np.load(X_path, mmap_mode='r'), np.load(y_path)
+
+
+def _save_replace(path, array):
+    """Save `array` under a temporary name renamed onto `path`, so that
+    processes which memory-mapped the old file keep reading it intact."""
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def preprocess_data(X, scaler=None, chunk_size=None, out=None):
     """Preprocess input data by standardise features 
-    by removing the mean and scaling to unit variance"""
+    by removing the mean and scaling to unit variance
+
+    If `chunk_size` is given, the scaler is fitted incrementally
+    (`StandardScaler.partial_fit`) and the data are transformed
+    `chunk_size` rows at a time into `out`, so `X` may be a memory-mapped
+    array larger than RAM. `out` may be `X` itself to standardise in
+    place, or e.g. a `numpy.memmap`; by default a new array is allocated.
+    If `out` is given without `chunk_size`, 10000 rows are processed at a
+    time, so that no full-size temporary is allocated either."""
+    if out is not None and not chunk_size:
+        chunk_size = 10000
     if not scaler:
         scaler = StandardScaler()
-        scaler.fit(X)
-    X = scaler.transform(X)
-    return X, scaler
+        if chunk_size:
+            for start in range(0, X.shape[0], chunk_size):
+                scaler.partial_fit(X[start:start + chunk_size])
+        else:
+            scaler.fit(X)
+    if not chunk_size and out is None:
+        X = scaler.transform(X)
+        return X, scaler
+    if out is None:
+        out = np.empty(X.shape, dtype=X.dtype)
+    for start in range(0, X.shape[0], chunk_size):
+        out[start:start + chunk_size] = scaler.transform(
+            X[start:start + chunk_size])
+    return out, scaler
 
 
-def preprocess_labels(labels, encoder=None, categorical=True):
-    """Encode labels with values among 0 and `n-classes-1`"""
+def preprocess_labels(labels, encoder=None, categorical=True, dtype=None):
+    """Encode labels with values among 0 and `n-classes-1`
+
+    Labels are encoded in a single vectorised pass: `np.unique` when
+    fitting a new encoder, a binary search in `encoder.classes_`
+    otherwise. With `categorical=False` the int32 class indices are
+    returned, e.g. for a `sparse_categorical_crossentropy` loss; with
+    `dtype`, the one-hot matrix is built with that (compact) type."""
+    labels = np.asarray(labels)
+    if labels.dtype == object:
+        labels = labels.astype(str)
     if not encoder:
         encoder = LabelEncoder()
-        encoder.fit(labels)
-    y = encoder.transform(labels).astype(np.int32)
-    if categorical:
+        encoder.classes_, y = np.unique(labels, return_inverse=True)
+    else:
+        y = np.searchsorted(encoder.classes_, labels)
+        y[y == len(encoder.classes_)] = 0
+        if not (encoder.classes_[y] == labels).all():
+            raise ValueError('labels contain previously unseen values')
+    y = y.astype(np.int32)
+    if categorical and dtype is not None:
+        y = np.eye(len(encoder.classes_), dtype=dtype)[y]
+    elif categorical:
         y = np_utils.to_categorical(y)
-    return y, encoder
\ No newline at end of file
+    return y, encoder
+
+
+PREPROCESSING_VERSION = 1
+
+
+def save_preprocessing(path, scaler=None, encoder=None):
+    """Save the fitted statistics of a scaler and/or the classes of an
+    encoder to a compact `.npz` file (e.g. next to the data cache,
+    as `train.csv.preprocessing.npz`), so that other processes can
+    transform data with `load_preprocessing` without refitting.
+
+    Parameters
+    ----------
+    path: str
+        The path of the file to write
+
+    scaler: sklearn.preprocessing.StandardScaler (default None)
+        A fitted scaler, as returned by `preprocess_data`
+
+    encoder: sklearn.preprocessing.LabelEncoder (default None)
+        A fitted encoder, as returned by `preprocess_labels`
+    """
+    arrays = {'version': np.int32(PREPROCESSING_VERSION)}
+    if scaler is not None:
+        arrays['with_mean'] = np.bool_(scaler.with_mean)
+        arrays['with_std'] = np.bool_(scaler.with_std)
+        arrays['n_samples_seen'] = np.asarray(scaler.n_samples_seen_)
+        for name in ('mean_', 'var_', 'scale_'):
+            if getattr(scaler, name) is not None:
+                arrays['scaler_' + name] = getattr(scaler, name)
+    if encoder is not None:
+        classes = encoder.classes_
+        if classes.dtype == object:
+            classes = classes.astype(str)
+        arrays['classes'] = classes
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def load_preprocessing(path):
+    """Load a scaler and an encoder saved with `save_preprocessing`
+
+    Return
+    ------
+    scaler: sklearn.preprocessing.StandardScaler
+        The fitted scaler, or None if none was saved
+    encoder: sklearn.preprocessing.LabelEncoder
+        The fitted encoder, or None if none was saved
+    """
+    with np.load(path) as arrays:
+        version = int(arrays['version'])
+        if version != PREPROCESSING_VERSION:
+            raise ValueError('Unsupported preprocessing file version %d '
+                             'in %s' % (version, path))
+        scaler = encoder = None
+        if 'n_samples_seen' in arrays:
+            scaler = StandardScaler(with_mean=bool(arrays['with_mean']),
+                                    with_std=bool(arrays['with_std']))
+            scaler.n_samples_seen_ = arrays['n_samples_seen'][()]
+            for name in ('mean_', 'var_', 'scale_'):
+                key = 'scaler_' + name
+                setattr(scaler, name, arrays[key] if key in arrays else None)
+            fitted = [scaler.scale_, scaler.mean_]
+            fitted = [stats for stats in fitted if stats is not None]
+            if fitted:
+                scaler.n_features_in_ = len(fitted[0])
+        if 'classes' in arrays:
+            encoder = LabelEncoder()
+            encoder.classes_ = arrays['classes']
+    return scaler, encoder
+
+
+def predict_submission(model, path, out_path, scaler=None, classes=None,
+                       chunksize=10000, batch_size=128):
+    """Score a test CSV file with a model and write a submission file,
+    one chunk at a time.
+
+    A reader thread parses the next chunk and a writer thread appends the
+    previous predictions to `out_path` while the model predicts the
+    current chunk, so memory stays bounded by a few chunks.
+
+    Parameters
+    ----------
+    model: keras.models.Model
+        The trained model
+
+    path: str
+        The path to the test CSV file (ids in the first column)
+
+    out_path: str
+        The path of the submission CSV file to write
+
+    scaler: sklearn.preprocessing.StandardScaler (default None)
+        A fitted scaler (see `load_preprocessing`), applied to each chunk
+
+    classes: sequence of str (default None)
+        The names of the prediction columns, e.g. `encoder.classes_`;
+        by default they are numbered
+
+    chunksize: int (default 10000)
+        Number of rows read, scored and written at a time
+
+    batch_size: int (default 128)
+        Batch size passed to `model.predict`
+    """
+    parsed, predicted = Queue(maxsize=2), Queue(maxsize=2)
+    errors = []
+    stop = threading.Event()
+
+    def read():
+        chunks = _iter_csv_chunks(path, train=False, chunksize=chunksize)
+        try:
+            with contextlib.closing(chunks):
+                for X, ids in chunks:
+                    if stop.is_set():
+                        break
+                    parsed.put((X, ids))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            parsed.put(None)
+
+    def write():
+        header = True
+        while True:
+            item = predicted.get()
+            if item is None:
+                return
+            if errors:
+                continue
+            try:
+                ids, proba = item
+                columns = classes
+                if columns is None:
+                    columns = ['class_%d' % i for i in range(proba.shape[1])]
+                df = pd.DataFrame(proba, columns=list(columns))
+                df.insert(0, 'id', ids)
+                df.to_csv(f, header=header, index=False)
+                header = False
+            except Exception as e:
+                errors.append(e)
+
+    # Opened here, so that a bad `out_path` fails before any thread starts.
+    f = open(out_path, 'w')
+    reader = threading.Thread(target=read)
+    writer = threading.Thread(target=write)
+    reader.daemon = writer.daemon = True
+    reader.start()
+    writer.start()
+    finished = False
+    try:
+        while True:
+            item = parsed.get()
+            if item is None:
+                finished = True
+                break
+            if errors:
+                continue
+            X, ids = item
+            if scaler is not None:
+                X = scaler.transform(X, copy=False)
+            predicted.put((ids, model.predict(X, batch_size=batch_size)))
+    finally:
+        stop.set()
+        if not finished:
+            # Unblock the reader, which then stops before the next chunk.
+            while parsed.get() is not None:
+                pass
+        predicted.put(None)
+        writer.join()
+        reader.join()
+        f.close()
+    if errors:
+        raise errors[0]
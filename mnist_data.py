@@ -18,10 +18,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import contextlib
+import copy
 import gzip
+import hashlib
 import os
+import shutil
+import threading
+from multiprocessing.pool import ThreadPool
 
 import numpy
+from six.moves import queue
 from six.moves import urllib
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
@@ -29,85 +37,411 @@ import tensorflow as tf
 SOURCE_URL = 'http://yann.lecun.com/exdb/mnist/'
 
 
-def maybe_download(filename, work_directory):
-  """Download the data from Yann's website, unless it's already here."""
+# SHA-256 digests of the published MNIST archives.
+SHA256_MANIFEST = {
+    'train-images-idx3-ubyte.gz':
+        '440fcabf73cc546fa21475e81ea370265605f56be210a4024d2ca8f203523609',
+    'train-labels-idx1-ubyte.gz':
+        '3552534a0a558bbed6aed32b30c495cca23d567ec52cac8be1a0730e8010255c',
+    't10k-images-idx3-ubyte.gz':
+        '8d422c7b0a1c1c79245a5bcf07fe86e33eeafee792b84584aec276f5a2dbc4e6',
+    't10k-labels-idx1-ubyte.gz':
+        'f7ae60f92e00ec6debd23a6088c31dbd2371eca3ffa0defaefb259924204aec6',
+}
+
+
+def _sha256(filepath):
+  digest = hashlib.sha256()
+  with open(filepath, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def _fetch(url, part_path):
+  """Download `url` into `part_path`, resuming from whatever is already there."""
+  offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+  request = urllib.request.Request(url)
+  if offset:
+    request.add_header('Range', 'bytes=%d-' % offset)
+  try:
+    response = urllib.request.urlopen(request)
+  except urllib.error.HTTPError as e:
+    if offset and e.code == 416:
+      # Nothing left to fetch: the partial file is already complete.
+      return
+    raise
+  with contextlib.closing(response):
+    if response.getcode() != 206:
+      # The server ignored the Range header and sent the whole file.
+      offset = 0
+    with open(part_path, 'ab' if offset else 'wb') as f:
+      shutil.copyfileobj(response, f, 1 << 16)
+
+
+def maybe_download(filename, work_directory, source_url=SOURCE_URL,
+                   sha256=None):
+  """Download the data from Yann's website, unless it's already here.
+
+  The download goes to `<filename>.part` and is only renamed into place once
+  complete (and, if `sha256` is given, verified), so an interrupted transfer
+  is resumed with an HTTP Range request instead of being taken for the whole
+  file.  An existing file that fails verification is downloaded again.
+  """
   if not tf.gfile.Exists(work_directory):
     tf.gfile.MakeDirs(work_directory)
   filepath = os.path.join(work_directory, filename)
-  if not tf.gfile.Exists(filepath):
-    filepath, _ = urllib.request.urlretrieve(SOURCE_URL + filename, filepath)
-    with tf.gfile.GFile(filepath) as f:
-      size = f.size()
-    print('Successfully downloaded', filename, size, 'bytes.')
+  if tf.gfile.Exists(filepath):
+    if sha256 is None or _sha256(filepath) == sha256:
+      return filepath
+    print('Checksum mismatch, downloading again', filename)
+    os.remove(filepath)
+  part_path = filepath + '.part'
+  _fetch(source_url + filename, part_path)
+  if sha256 is not None:
+    digest = _sha256(part_path)
+    if digest != sha256:
+      os.remove(part_path)
+      raise IOError('SHA-256 mismatch for %s: expected %s, got %s' %
+                    (filename, sha256, digest))
+  os.rename(part_path, filepath)
+  print('Successfully downloaded', filename, os.path.getsize(filepath),
+        'bytes.')
   return filepath
 
 
+def maybe_download_all(filenames, work_directory, source_url=SOURCE_URL,
+                       manifest=None, workers=4):
+  """Download several files concurrently with `maybe_download`.
+
+  Each file is verified against its SHA-256 digest in `manifest` (by default
+  `SHA256_MANIFEST`); files missing from the manifest are not verified.
+  Returns the local paths in the order of `filenames`.
+  """
+  if manifest is None:
+    manifest = SHA256_MANIFEST
+  if not tf.gfile.Exists(work_directory):
+    tf.gfile.MakeDirs(work_directory)
+
+  def download(filename):
+    return maybe_download(filename, work_directory, source_url=source_url,
+                          sha256=manifest.get(filename))
+
+  pool = ThreadPool(max(1, min(workers, len(filenames))))
+  try:
+    return pool.map(download, filenames)
+  finally:
+    pool.close()
+    pool.join()
+
+
 def _read32(bytestream):
   dt = numpy.dtype(numpy.uint32).newbyteorder('>')
   return numpy.frombuffer(bytestream.read(4), dtype=dt)[0]
 
 
-def extract_images(filename):
-  """Extract the images into a 4D uint8 numpy array [index, y, x, depth]."""
+def _decompress_once(filename):
+  """Gunzip `filename` into a raw IDX sidecar next to it, unless one exists.
+
+  The sidecar keeps the IDX header verbatim, so it is self-describing.  It is
+  written under a temporary name and renamed into place, so concurrent
+  workers never observe a partially written cache.
+  """
+  if filename.endswith('.gz'):
+    raw_path = filename[:-len('.gz')]
+  else:
+    raw_path = filename + '.raw'
+  if (os.path.exists(raw_path) and
+      os.path.getmtime(raw_path) >= os.path.getmtime(filename)):
+    return raw_path
+  tmp_path = '%s.tmp%d' % (raw_path, os.getpid())
+  with tf.gfile.Open(filename, 'rb') as f, \
+      gzip.GzipFile(fileobj=f) as bytestream, \
+      open(tmp_path, 'wb') as out:
+    shutil.copyfileobj(bytestream, out, 1 << 20)
+  os.rename(tmp_path, raw_path)
+  return raw_path
+
+
+def _idx_memmap(filename, magic, kind):
+  """Return a read-only `numpy.memmap` over the payload of an IDX file.
+
+  The gzipped file is decompressed only once; every later call (from any
+  process) maps the same sidecar, so the pages are shared through the page
+  cache instead of being copied into each process.
+  """
+  raw_path = _decompress_once(filename)
+  with open(raw_path, 'rb') as bytestream:
+    found = _read32(bytestream)
+    if found != magic:
+      raise ValueError(
+          'Invalid magic number %d in MNIST %s file: %s' %
+          (found, kind, filename))
+    # The low byte of the magic number is the number of dimensions.
+    shape = tuple(int(_read32(bytestream)) for _ in xrange(magic & 0xff))
+  offset = 4 * (len(shape) + 1)
+  if os.path.getsize(raw_path) != offset + int(numpy.prod(shape)):
+    raise ValueError('Truncated MNIST %s cache: %s' % (kind, raw_path))
+  return numpy.memmap(raw_path, dtype=numpy.uint8, mode='r',
+                      offset=offset, shape=shape)
+
+
+def extract_images(filename, mmap=False):
+  """Extract the images into a 4D uint8 numpy array [index, y, x, depth].
+
+  If `mmap` is true, the file is decompressed once into a raw sidecar and the
+  images are returned as a read-only `numpy.memmap` view of it.
+  """
   print('Extracting', filename)
+  if mmap:
+    data = _idx_memmap(filename, 2051, 'image')
+    return data.reshape(data.shape + (1,))
   with tf.gfile.Open(filename, 'rb') as f, gzip.GzipFile(fileobj=f) as bytestream:
-    magic = _read32(bytestream)
-    if magic != 2051:
-      raise ValueError(
-          'Invalid magic number %d in MNIST image file: %s' %
-          (magic, filename))
-    num_images = _read32(bytestream)
-    rows = _read32(bytestream)
-    cols = _read32(bytestream)
+    num_images, rows, cols = _read_image_header(bytestream, filename)
     buf = bytestream.read(rows * cols * num_images)
     data = numpy.frombuffer(buf, dtype=numpy.uint8)
     data = data.reshape(num_images, rows, cols, 1)
     return data
 
 
-def dense_to_one_hot(labels_dense, num_classes=10):
-  """Convert class labels from scalars to one-hot vectors."""
+def _read_image_header(bytestream, filename):
+  """Parse an IDX image header; return `(num_images, rows, cols)`."""
+  magic = _read32(bytestream)
+  if magic != 2051:
+    raise ValueError(
+        'Invalid magic number %d in MNIST image file: %s' %
+        (magic, filename))
+  num_images = _read32(bytestream)
+  rows = _read32(bytestream)
+  cols = _read32(bytestream)
+  return num_images, rows, cols
+
+
+@contextlib.contextmanager
+def _open_idx(filename):
+  """Open an IDX file, gzipped or raw, as a binary stream."""
+  with tf.gfile.Open(filename, 'rb') as f:
+    if filename.endswith('.gz'):
+      bytestream = gzip.GzipFile(fileobj=f)
+    else:
+      bytestream = f
+    with contextlib.closing(bytestream):
+      yield bytestream
+
+
+def iter_idx_images(filename, chunk_rows=10000):
+  """Yield the images of an IDX file in chunks of at most `chunk_rows`.
+
+  The file may be gzipped or raw.  Every chunk is a 4D uint8 view
+  [index, y, x, depth] of one buffer that is refilled for the next chunk, so
+  only `chunk_rows` images are ever held in memory.
+  """
+  with _open_idx(filename) as bytestream:
+    num_images, rows, cols = _read_image_header(bytestream, filename)
+    image_size = int(rows * cols)
+    buf = numpy.empty((min(chunk_rows, num_images), rows, cols, 1),
+                      dtype=numpy.uint8)
+    remaining = int(num_images)
+    while remaining:
+      size = min(remaining, buf.shape[0])
+      view = memoryview(buf.reshape(-1))[:size * image_size]
+      filled = 0
+      while filled < len(view):
+        read = bytestream.readinto(view[filled:])
+        if not read:
+          raise ValueError('Truncated MNIST image file: %s' % filename)
+        filled += read
+      remaining -= size
+      yield buf[:size]
+
+
+def dense_to_one_hot(labels_dense, num_classes=10, dtype=numpy.float64,
+                     out=None):
+  """Convert class labels from scalars to one-hot vectors.
+
+  `dtype` selects the element type of the result, e.g. `uint8` or `float32`
+  for a compact matrix.  If `out` is given, the vectors are written into it.
+  """
   num_labels = labels_dense.shape[0]
   index_offset = numpy.arange(num_labels) * num_classes
-  labels_one_hot = numpy.zeros((num_labels, num_classes))
-  labels_one_hot.flat[index_offset + labels_dense.ravel()] = 1
-  return labels_one_hot
+  if out is None:
+    out = numpy.zeros((num_labels, num_classes), dtype=dtype)
+  else:
+    out.fill(0)
+  out.flat[index_offset + labels_dense.ravel()] = 1
+  return out
 
 
-def extract_labels(filename, one_hot=False):
-  """Extract the labels into a 1D uint8 numpy array [index]."""
-  print('Extracting', filename)
-  with tf.gfile.Open(filename, 'rb') as f, gzip.GzipFile(fileobj=f) as bytestream:
-    magic = _read32(bytestream)
-    if magic != 2049:
-      raise ValueError(
-          'Invalid magic number %d in MNIST label file: %s' %
-          (magic, filename))
-    num_items = _read32(bytestream)
-    buf = bytestream.read(num_items)
-    labels = numpy.frombuffer(buf, dtype=numpy.uint8)
-    if one_hot:
-      return dense_to_one_hot(labels)
+class OneHotLabels(object):
+  """Read-only one-hot view of dense class labels.
+
+  Only the class ids are stored.  As with numpy arrays, indexing with a slice
+  returns another view, while integer or array indexing materializes the
+  selected one-hot rows.
+  """
+
+  def __init__(self, labels_dense, num_classes=10, dtype=numpy.float64):
+    self.dense = labels_dense
+    self.num_classes = num_classes
+    self.dtype = numpy.dtype(dtype)
+
+  @property
+  def shape(self):
+    return (self.dense.shape[0], self.num_classes)
+
+  def __len__(self):
+    return self.dense.shape[0]
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      return OneHotLabels(self.dense[key], self.num_classes, self.dtype)
+    rows = self.dense[key]
+    if numpy.ndim(rows) == 0:
+      return dense_to_one_hot(numpy.reshape(rows, 1), self.num_classes,
+                              self.dtype)[0]
+    return dense_to_one_hot(rows, self.num_classes, self.dtype)
+
+  def __array__(self, dtype=None, copy=None):
+    labels = dense_to_one_hot(self.dense, self.num_classes, self.dtype)
+    if dtype is not None:
+      labels = labels.astype(dtype)
     return labels
 
 
+def extract_labels(filename, one_hot=False, mmap=False,
+                   one_hot_dtype=numpy.float64, lazy_one_hot=False):
+  """Extract the labels into a 1D uint8 numpy array [index].
+
+  If `mmap` is true, the labels are returned as a read-only `numpy.memmap`
+  view of a decompress-once sidecar file (see `extract_images`).  With
+  `one_hot`, the labels are returned as a `one_hot_dtype` matrix, or as a
+  `OneHotLabels` view if `lazy_one_hot` is true.
+  """
+  print('Extracting', filename)
+  if mmap:
+    labels = _idx_memmap(filename, 2049, 'label')
+  else:
+    with tf.gfile.Open(filename, 'rb') as f, \
+        gzip.GzipFile(fileobj=f) as bytestream:
+      magic = _read32(bytestream)
+      if magic != 2049:
+        raise ValueError(
+            'Invalid magic number %d in MNIST label file: %s' %
+            (magic, filename))
+      num_items = _read32(bytestream)
+      buf = bytestream.read(num_items)
+      labels = numpy.frombuffer(buf, dtype=numpy.uint8)
+  if one_hot and lazy_one_hot:
+    return OneHotLabels(labels, dtype=one_hot_dtype)
+  if one_hot:
+    return dense_to_one_hot(labels, dtype=one_hot_dtype)
+  return labels
+
+
+class SyntheticData(object):
+  """Synthetic batches for measuring model throughput without input I/O.
+
+  The examples are generated once into preallocated arrays and every batch
+  is a view of them, so `next_batch` neither allocates nor copies.
+  `distribution` is `'ones'` (all-ones images of class 0, as the historical
+  `fake_data` batches), `'uniform'` (images in `[0, 1)`, or the full range for
+  integer dtypes, with random classes) or `'normal'` (standard normal
+  images, float dtypes only, with random classes).
+  """
+
+  def __init__(self, image_shape=(784,), num_classes=10, one_hot=False,
+               dtype=numpy.float32, distribution='ones', seed=None):
+    if distribution not in ('ones', 'uniform', 'normal'):
+      raise ValueError('Invalid distribution %r, expected ones, uniform or '
+                       'normal' % (distribution,))
+    self._image_shape = tuple(image_shape)
+    self._num_classes = num_classes
+    self._one_hot = one_hot
+    self._dtype = numpy.dtype(dtype)
+    if distribution == 'normal' and self._dtype.kind != 'f':
+      raise ValueError('The normal distribution needs a float dtype, got %s' %
+                       self._dtype)
+    self._distribution = distribution
+    self._rng = numpy.random.RandomState(seed)
+    self._images = None
+    self._labels = None
+
+  def next_batch(self, batch_size):
+    """Return `batch_size` synthetic examples as views of shared arrays."""
+    if self._images is None or self._images.shape[0] < batch_size:
+      self._generate(batch_size)
+    return self._images[:batch_size], self._labels[:batch_size]
+
+  def _generate(self, size):
+    shape = (size,) + self._image_shape
+    if self._distribution == 'ones':
+      images = numpy.ones(shape, dtype=self._dtype)
+      labels = numpy.zeros(size, dtype=numpy.uint8)
+    else:
+      if self._distribution == 'normal':
+        images = self._rng.standard_normal(shape).astype(self._dtype)
+      elif self._dtype.kind == 'f':
+        images = self._rng.random_sample(shape).astype(self._dtype)
+      else:
+        info = numpy.iinfo(self._dtype)
+        images = self._rng.randint(info.min, int(info.max) + 1, size=shape)
+        images = images.astype(self._dtype)
+      labels = self._rng.randint(self._num_classes, size=size)
+      labels = labels.astype(numpy.uint8)
+    if self._one_hot:
+      labels = dense_to_one_hot(labels, self._num_classes)
+    self._images = images
+    self._labels = labels
+
+
 class DataSet(object):
 
   def __init__(self, images, labels, fake_data=False, one_hot=False,
-               dtype=tf.float32):
+               dtype=tf.float32, index_shuffle=False, lazy_normalize=False,
+               epoch_tail='drop'):
     """Construct a DataSet.
 
-    one_hot arg is used only if fake_data is true.  `dtype` can be either
+    one_hot arg is used only if fake_data is true, in which case batches
+    come from a `SyntheticData` source.  `dtype` can be either
     `uint8` to leave the input as `[0, 255]`, or `float32` to rescale into
     `[0, 1]`.
+
+    If `index_shuffle` is true, `images` and `labels` are never reordered:
+    only the permutation of the current epoch is stored and each batch is
+    gathered into a preallocated buffer that is reused by the next call, so
+    the arrays returned by `next_batch` are only valid until then.  The same
+    applies when `labels` is a `OneHotLabels` view, whose one-hot rows are
+    only built for the examples of each batch.
+
+    If `lazy_normalize` is true and `dtype` is `float32`, images are kept as
+    `uint8` and only the examples of each batch are rescaled, into a reused
+    float32 buffer as above; the `images` property then builds a rescaled
+    copy on every access.
+
+    `epoch_tail` decides what happens to the examples left at the end of an
+    epoch when fewer than a batch remain: `'drop'` skips them, `'short'`
+    returns them as a final short batch, and `'wrap'` completes the batch
+    with the first examples of the next epoch, in a reused buffer as above.
     """
     dtype = tf.as_dtype(dtype).base_dtype
     if dtype not in (tf.uint8, tf.float32):
       raise TypeError('Invalid image dtype %r, expected uint8 or float32' %
                       dtype)
+    if epoch_tail not in ('drop', 'short', 'wrap'):
+      raise ValueError('Invalid epoch_tail %r, expected drop, short or wrap' %
+                       (epoch_tail,))
+    self._scale = None
+    self._num_classes = None
+    if isinstance(labels, OneHotLabels):
+      # Keep only the class ids; one-hot rows are built per batch.
+      self._num_classes = labels.num_classes
+      self._label_dtype = labels.dtype
+      labels = labels.dense
     if fake_data:
       self._num_examples = 10000
       self.one_hot = one_hot
+      self._synthetic = SyntheticData(one_hot=one_hot,
+                                      dtype=dtype.as_numpy_dtype)
     else:
       assert images.shape[0] == labels.shape[0], (
           'images.shape: %s labels.shape: %s' % (images.shape,
@@ -119,7 +453,10 @@ class DataSet(object):
       assert images.shape[3] == 1
       images = images.reshape(images.shape[0],
                               images.shape[1] * images.shape[2])
-      if dtype == tf.float32:
+      if dtype == tf.float32 and lazy_normalize:
+        # Convert from [0, 255] -> [0.0, 1.0] one batch at a time.
+        self._scale = numpy.float32(1.0 / 255.0)
+      elif dtype == tf.float32:
         # Convert from [0, 255] -> [0.0, 1.0].
         images = images.astype(numpy.float32)
         images = numpy.multiply(images, 1.0 / 255.0)
@@ -127,13 +464,27 @@ class DataSet(object):
     self._labels = labels
     self._epochs_completed = 0
     self._index_in_epoch = 0
+    self._examples_per_epoch = []
+    self._epoch_tail = epoch_tail
+    self._index_shuffle = index_shuffle
+    self._perm = None
+    # Seeded from the global generator, so `numpy.random.seed` still makes
+    # the shuffling reproducible, but never shared with it afterwards.
+    self._rng = numpy.random.RandomState(numpy.random.randint(2**31))
+    self._shard = None
+    self._image_buffer = None
+    self._label_buffer = None
 
   @property
   def images(self):
+    if self._scale is not None:
+      return numpy.multiply(self._images, self._scale, dtype=numpy.float32)
     return self._images
 
   @property
   def labels(self):
+    if self._num_classes is not None:
+      return OneHotLabels(self._labels, self._num_classes, self._label_dtype)
     return self._labels
 
   @property
@@ -144,35 +495,336 @@ class DataSet(object):
   def epochs_completed(self):
     return self._epochs_completed
 
+  @property
+  def examples_in_epoch(self):
+    """Number of examples returned so far in the current epoch."""
+    return self._index_in_epoch
+
+  @property
+  def examples_per_epoch(self):
+    """Number of examples returned in each completed epoch."""
+    return list(self._examples_per_epoch)
+
   def next_batch(self, batch_size, fake_data=False):
     """Return the next `batch_size` examples from this data set."""
     if fake_data:
-      fake_image = [1] * 784
-      if self.one_hot:
-        fake_label = [1] + [0] * 9
-      else:
-        fake_label = 0
-      return [fake_image for _ in xrange(batch_size)], [
-          fake_label for _ in xrange(batch_size)]
+      return self._synthetic.next_batch(batch_size)
+    if (not self._index_shuffle and self._scale is None and
+        self._num_classes is None and self._epoch_tail != 'wrap'):
+      start, end = self._advance(batch_size)
+      return self._images[start:end], self._labels[start:end]
+    if self._image_buffer is None or self._image_buffer.shape[0] != batch_size:
+      self._image_buffer, self._label_buffer = self._empty_batch(batch_size)
+    return self._fill(batch_size, self._image_buffer, self._label_buffer)
+
+  def prefetching_iterator(self, batch_size, depth=2, seed=None,
+                           num_batches=None):
+    """Yield `(images, labels)` batches prepared on a background thread.
+
+    Up to `depth` batches are produced ahead of the consumer into a ring of
+    `depth + 1` preallocated buffers; a yielded batch stays valid until the
+    next one is requested.  The batches are the ones successive `next_batch`
+    calls would return, and this DataSet's cursor is advanced accordingly, so
+    `next_batch` must not be called while the iterator is in use.  If `seed`
+    is given, the shuffling (and hence the batch order) is deterministic.
+    Iteration stops after `num_batches` batches, or never if it is None;
+    closing the generator (e.g. leaving a `for` loop) stops the thread and
+    rolls the cursor (and this DataSet's own shuffling state, never the global
+    one) back over the batches prepared but not yielded, so `next_batch`
+    carries on with the first of them.
+    """
+    if seed is not None:
+      self._rng = numpy.random.RandomState(seed)
+    free = queue.Queue()
+    ready = queue.Queue()
+    for _ in xrange(depth + 1):
+      free.put(self._empty_batch(batch_size))
+    stop = threading.Event()
+    # Cursor states before each batch prepared but not yet yielded.
+    pending = collections.deque()
+
+    def produce():
+      produced = 0
+      try:
+        while num_batches is None or produced < num_batches:
+          slot = free.get()
+          if slot is None or stop.is_set():
+            return
+          pending.append(self._cursor_state())
+          ready.put((slot, self._fill(batch_size, *slot)))
+          produced += 1
+      except Exception as e:  # pylint: disable=broad-except
+        ready.put(e)
+        return
+      ready.put(None)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    held = None
+    try:
+      while True:
+        item = ready.get()
+        if held is not None:
+          free.put(held)
+          held = None
+        if item is None:
+          return
+        if isinstance(item, Exception):
+          raise item
+        held, batch = item
+        pending.popleft()
+        yield batch
+    finally:
+      stop.set()
+      free.put(None)
+      producer.join()
+      if pending:
+        self._restore_cursor(pending[0])
+
+  def shard(self, num_shards, index, seed=0):
+    """Return a view of the `index`-th of `num_shards` disjoint shards.
+
+    The view shares the underlying arrays (or memmaps) and has its own
+    cursor.  Every epoch, each shard takes its slice of a permutation drawn
+    from `(seed, epoch)` alone, so workers given the same `seed` agree on the
+    permutation without communicating and never see the same example within
+    an epoch.  All shards hold `num_examples // num_shards` examples; the
+    remainder is left out for the epoch.  The `images` and `labels`
+    properties of a shard still refer to the whole underlying set.
+    """
+    if self._shard is not None:
+      raise ValueError('Cannot shard a DataSet shard')
+    if not 0 <= index < num_shards:
+      raise ValueError('Invalid shard index %d for %d shards' %
+                       (index, num_shards))
+    view = copy.copy(self)
+    view._shard = (num_shards, index, seed)
+    view._num_examples = self._images.shape[0] // num_shards
+    view._index_shuffle = True
+    view._perm = view._shard_rows(0)
+    view._epochs_completed = 0
+    view._index_in_epoch = 0
+    view._examples_per_epoch = []
+    view._image_buffer = None
+    view._label_buffer = None
+    return view
+
+  def _shard_rows(self, epoch):
+    """Rows of the underlying arrays visited by this shard in `epoch`."""
+    num_shards, index, seed = self._shard
+    total = self._images.shape[0]
+    if epoch == 0:
+      perm = numpy.arange(total)
+    else:
+      perm = numpy.random.RandomState([seed, epoch]).permutation(total)
+    start = index * self._num_examples
+    return perm[start:start + self._num_examples]
+
+  def _advance(self, batch_size):
+    """Move the cursor by up to `batch_size`; return `[start, end)` positions.
+
+    Starts a new epoch first if the current one has no examples left (or,
+    with `epoch_tail='drop'`, fewer than `batch_size`).
+    """
     start = self._index_in_epoch
-    self._index_in_epoch += batch_size
-    if self._index_in_epoch > self._num_examples:
-      # Finished epoch
-      self._epochs_completed += 1
-      # Shuffle the data
+    if self._epoch_tail == 'drop':
+      finished = start + batch_size > self._num_examples
+    else:
+      finished = start >= self._num_examples
+    if finished:
+      self._start_epoch()
+      start = 0
+      if self._epoch_tail == 'drop':
+        assert batch_size <= self._num_examples
+    self._index_in_epoch = min(start + batch_size, self._num_examples)
+    return start, self._index_in_epoch
+
+  def _cursor_state(self):
+    """Snapshot everything `next_batch` advances, for `_restore_cursor`."""
+    return (self._index_in_epoch, self._epochs_completed,
+            len(self._examples_per_epoch), self._perm, self._images,
+            self._labels, self._rng.get_state())
+
+  def _restore_cursor(self, state):
+    (self._index_in_epoch, self._epochs_completed, num_epochs, self._perm,
+     self._images, self._labels, rng_state) = state
+    del self._examples_per_epoch[num_epochs:]
+    self._rng.set_state(rng_state)
+
+  def _start_epoch(self):
+    # Finished epoch
+    self._examples_per_epoch.append(self._index_in_epoch)
+    self._epochs_completed += 1
+    self._index_in_epoch = 0
+    # Shuffle the data
+    if self._shard is not None:
+      perm = self._shard_rows(self._epochs_completed)
+    else:
       perm = numpy.arange(self._num_examples)
-      numpy.random.shuffle(perm)
+      self._rng.shuffle(perm)
+    if self._index_shuffle:
+      # Keep the arrays in place and only remember the epoch order.
+      self._perm = perm
+    else:
       self._images = self._images[perm]
       self._labels = self._labels[perm]
-      # Start next epoch
-      start = 0
-      self._index_in_epoch = batch_size
-      assert batch_size <= self._num_examples
-    end = self._index_in_epoch
-    return self._images[start:end], self._labels[start:end]
 
+  def _fill(self, batch_size, images, labels):
+    """Write the next batch into buffers; return views of the filled part.
+
+    With `epoch_tail='wrap'` a batch crossing the end of an epoch is gathered
+    in two pieces, before and after the next epoch is shuffled.
+    """
+    filled = 0
+    while filled < batch_size:
+      start, end = self._advance(batch_size - filled)
+      size = end - start
+      self._gather(start, end, images[filled:filled + size],
+                   labels[filled:filled + size])
+      filled += size
+      if self._epoch_tail != 'wrap':
+        break
+    return images[:filled], labels[:filled]
+
+  def _empty_batch(self, batch_size):
+    """Allocate an `(images, labels)` pair of buffers for one batch."""
+    if self._scale is None:
+      image_dtype = self._images.dtype
+    else:
+      image_dtype = numpy.float32
+    images = numpy.empty((batch_size,) + self._images.shape[1:],
+                         dtype=image_dtype)
+    if self._num_classes is None:
+      labels = numpy.empty((batch_size,) + self._labels.shape[1:],
+                           dtype=self._labels.dtype)
+    else:
+      labels = numpy.empty((batch_size, self._num_classes),
+                           dtype=self._label_dtype)
+    return images, labels
+
+  def _gather(self, start, end, images, labels):
+    """Copy the examples at epoch positions `[start, end)` into buffers."""
+    if self._perm is None:
+      rows = slice(start, end)
+    else:
+      rows = self._perm[start:end]
+    if self._num_classes is not None:
+      dense_to_one_hot(self._labels[rows], self._num_classes, out=labels)
+    elif self._perm is None:
+      numpy.copyto(labels, self._labels[rows])
+    else:
+      # The rows are a permutation, so mode='clip' never clips; unlike the
+      # default 'raise' it lets `take` write straight into the buffer.
+      numpy.take(self._labels, rows, axis=0, out=labels, mode='clip')
+    if self._scale is not None:
+      # Only this batch is converted; the stored images stay uint8.
+      numpy.multiply(self._images[rows], self._scale, out=images)
+    elif self._perm is None:
+      numpy.copyto(images, self._images[rows])
+    else:
+      numpy.take(self._images, rows, axis=0, out=images, mode='clip')
+    return images, labels
+
+
+class StreamingDataSet(object):
+  """Out-of-core counterpart of `DataSet` for image files larger than RAM.
+
+  Images are streamed from the IDX file with `iter_idx_images` on every
+  epoch, `chunk_rows` at a time, and shuffled within each chunk; `labels`
+  are held in memory.  Like `DataSet.next_batch`, an epoch ends once fewer
+  than `batch_size` examples remain, and the returned arrays are reused by
+  the next call.
+  """
+
+  def __init__(self, images_filename, labels, chunk_rows=10000,
+               dtype=tf.float32, seed=None):
+    dtype = tf.as_dtype(dtype).base_dtype
+    if dtype not in (tf.uint8, tf.float32):
+      raise TypeError('Invalid image dtype %r, expected uint8 or float32' %
+                      dtype)
+    with _open_idx(images_filename) as bytestream:
+      num_images = _read_image_header(bytestream, images_filename)[0]
+    if num_images != labels.shape[0]:
+      raise ValueError('%d images in %s but labels.shape: %s' %
+                       (num_images, images_filename, labels.shape))
+    self._filename = images_filename
+    self._labels = labels
+    self._num_examples = labels.shape[0]
+    self._chunk_rows = chunk_rows
+    self._scale = numpy.float32(1.0 / 255.0) if dtype == tf.float32 else None
+    self._rng = numpy.random.RandomState(seed)
+    self._epochs_completed = 0
+    self._image_buffer = None
+    self._label_buffer = None
+    self._stream = None
+    self._start_epoch()
+
+  @property
+  def labels(self):
+    return self._labels
 
-def read_data_sets(train_dir, fake_data=False, one_hot=False, dtype=tf.float32):
+  @property
+  def num_examples(self):
+    return self._num_examples
+
+  @property
+  def epochs_completed(self):
+    return self._epochs_completed
+
+  def next_batch(self, batch_size):
+    """Return the next `batch_size` examples from this data set."""
+    assert batch_size <= self._num_examples
+    if self._index_in_epoch + batch_size > self._num_examples:
+      # Finished epoch
+      self._epochs_completed += 1
+      self._start_epoch()
+    if self._image_buffer is None or self._image_buffer.shape[0] != batch_size:
+      self._image_buffer = numpy.empty(
+          (batch_size, self._chunk[0].size),
+          dtype=numpy.uint8 if self._scale is None else numpy.float32)
+      self._label_buffer = numpy.empty(
+          (batch_size,) + self._labels.shape[1:], dtype=self._labels.dtype)
+    filled = 0
+    while filled < batch_size:
+      if self._position == len(self._order):
+        self._next_chunk()
+      size = min(batch_size - filled, len(self._order) - self._position)
+      rows = self._order[self._position:self._position + size]
+      images = self._chunk[rows].reshape(size, -1)
+      out = self._image_buffer[filled:filled + size]
+      if self._scale is None:
+        numpy.copyto(out, images)
+      else:
+        numpy.multiply(images, self._scale, out=out)
+      numpy.copyto(self._label_buffer[filled:filled + size],
+                   self._labels[self._offset + rows])
+      self._position += size
+      filled += size
+    self._index_in_epoch += batch_size
+    return self._image_buffer, self._label_buffer
+
+  def _start_epoch(self):
+    if self._stream is not None:
+      self._stream.close()
+    self._stream = iter_idx_images(self._filename, self._chunk_rows)
+    self._index_in_epoch = 0
+    self._offset = 0
+    self._order = numpy.arange(0)
+    self._position = 0
+    self._next_chunk()
+
+  def _next_chunk(self):
+    self._offset += len(self._order)
+    self._chunk = next(self._stream)
+    self._order = self._rng.permutation(self._chunk.shape[0])
+    self._position = 0
+
+
+def read_data_sets(train_dir, fake_data=False, one_hot=False, dtype=tf.float32,
+                   mmap=False, index_shuffle=False, lazy_normalize=False,
+                   source_url=SOURCE_URL, one_hot_dtype=numpy.float64,
+                   lazy_one_hot=False, epoch_tail='drop'):
   class DataSets(object):
     pass
   data_sets = DataSets()
@@ -191,26 +843,27 @@ def read_data_sets(train_dir, fake_data=False, one_hot=False, dtype=tf.float32):
   TEST_LABELS = 't10k-labels-idx1-ubyte.gz'
   VALIDATION_SIZE = 5000
 
-  local_file = maybe_download(TRAIN_IMAGES, train_dir)
-  train_images = extract_images(local_file)
-
-  local_file = maybe_download(TRAIN_LABELS, train_dir)
-  train_labels = extract_labels(local_file, one_hot=one_hot)
-
-  local_file = maybe_download(TEST_IMAGES, train_dir)
-  test_images = extract_images(local_file)
+  local_files = maybe_download_all(
+      [TRAIN_IMAGES, TRAIN_LABELS, TEST_IMAGES, TEST_LABELS], train_dir,
+      source_url=source_url)
 
-  local_file = maybe_download(TEST_LABELS, train_dir)
-  test_labels = extract_labels(local_file, one_hot=one_hot)
+  train_images = extract_images(local_files[0], mmap=mmap)
+  label_options = dict(one_hot=one_hot, mmap=mmap,
+                       one_hot_dtype=one_hot_dtype, lazy_one_hot=lazy_one_hot)
+  train_labels = extract_labels(local_files[1], **label_options)
+  test_images = extract_images(local_files[2], mmap=mmap)
+  test_labels = extract_labels(local_files[3], **label_options)
 
   validation_images = train_images[:VALIDATION_SIZE]
   validation_labels = train_labels[:VALIDATION_SIZE]
   train_images = train_images[VALIDATION_SIZE:]
   train_labels = train_labels[VALIDATION_SIZE:]
 
-  data_sets.train = DataSet(train_images, train_labels, dtype=dtype)
+  options = dict(dtype=dtype, index_shuffle=index_shuffle,
+                 lazy_normalize=lazy_normalize, epoch_tail=epoch_tail)
+  data_sets.train = DataSet(train_images, train_labels, **options)
   data_sets.validation = DataSet(validation_images, validation_labels,
-                                 dtype=dtype)
-  data_sets.test = DataSet(test_images, test_labels, dtype=dtype)
+                                 **options)
+  data_sets.test = DataSet(test_images, test_labels, **options)
 
   return data_sets
\ No newline at end of file